@@ -1,15 +1,28 @@
 import os
-import json
-import uuid
+import hashlib
+import hmac
+import re
+import secrets
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 from typing import List, Optional
 
-from fastapi import FastAPI, Depends, HTTPException, Header
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
+from fastapi import FastAPI, Depends, HTTPException, Header, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr, TypeAdapter
 from sqlalchemy import (
-    create_engine,
+    select,
+    update,
+    delete,
+    event,
     Column,
     String,
     Boolean,
@@ -17,8 +30,9 @@ from sqlalchemy import (
     ForeignKey,
     Index,
 )
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, relationship
 
 
 # =========================
@@ -26,16 +40,65 @@ from sqlalchemy.orm import sessionmaker, Session, relationship
 # =========================
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+connect_args = {}
 if DATABASE_URL:
-    # Render / PostgreSQL
-    connect_args = {}
+    # Render / PostgreSQL, драйвер asyncpg
+    for prefix in ("postgres://", "postgresql://"):
+        if DATABASE_URL.startswith(prefix):
+            DATABASE_URL = "postgresql+asyncpg://" + DATABASE_URL[len(prefix):]
+            break
+
+    # asyncpg не понимает libpq-параметры в query: sslmode переводим в его
+    # аргумент ssl (он принимает те же значения), остальные ssl* — отвергаем
+    url = make_url(DATABASE_URL)
+    if url.drivername == "postgresql+asyncpg":
+        unsupported = sorted(
+            key for key in url.query if key.startswith("ssl") and key != "sslmode"
+        )
+        if unsupported:
+            raise RuntimeError(
+                "DATABASE_URL: параметры " + ", ".join(unsupported)
+                + " не поддерживаются драйвером asyncpg"
+            )
+        if "sslmode" in url.query:
+            connect_args["ssl"] = url.query["sslmode"]
+            url = url.difference_update_query(["sslmode"])
+        DATABASE_URL = url.render_as_string(hide_password=False)
+else:
+    # Локальный fallback: SQLite через aiosqlite
+    DATABASE_URL = "sqlite+aiosqlite:///./tasks.db"
+
+if DATABASE_URL.startswith("postgresql"):
+    # пул побольше дефолтных 5 + 10, битые соединения отсеиваем pre-ping'ом
+    engine_kwargs = dict(
+        pool_size=20,
+        max_overflow=20,
+        pool_pre_ping=True,
+        pool_recycle=1800,
+    )
 else:
-    # Локальный fallback: SQLite
-    DATABASE_URL = "sqlite:///./tasks.db"
-    connect_args = {"check_same_thread": False}
+    # SQLite оставляем на стандартном пуле: у каждой сессии своё соединение,
+    # а параллельных читателей и так пускает WAL
+    engine_kwargs = {}
 
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+engine = create_async_engine(
+    DATABASE_URL, connect_args=connect_args, **engine_kwargs
+)
+
+if engine.dialect.name == "sqlite":
+    # события пула вешаются на синхронный движок под async-обёрткой
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL + NORMAL: читатели не блокируют писателя, fsync не на каждый commit
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.close()
+
+# все поля задаём сами, поэтому после commit перечитывать объекты незачем
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
@@ -58,8 +121,11 @@ class UserORM(Base):
 
 class SessionORM(Base):
     __tablename__ = "sessions"
+    # в SQLite строковый PK — не алиас rowid; без rowid поиск по токену
+    # идёт сразу по B-дереву первичного ключа, без второго прохода
+    __table_args__ = {"sqlite_with_rowid": False}
 
-    token = Column(String, primary_key=True, index=True)
+    token = Column(String, primary_key=True)
     user_id = Column(String, ForeignKey("users.id"), nullable=False, index=True)
 
     user = relationship("UserORM")
@@ -85,15 +151,13 @@ class TaskORM(Base):
     user = relationship("UserORM", back_populates="tasks")
 
 
-Index("ix_tasks_user_id_createdAt", TaskORM.user_id, TaskORM.createdAt)
+# новые задачи отдаём первыми — индекс в том же порядке, что и ORDER BY
+Index("ix_tasks_user_id_createdAt_desc", TaskORM.user_id, TaskORM.createdAt.desc())
 
 
-def get_db() -> Session:
-    db = SessionLocal()
-    try:
+async def get_db() -> AsyncSession:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 # =========================
@@ -106,8 +170,7 @@ class UserPublic(BaseModel):
     name: str
     created_at: str
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class UserCreate(BaseModel):
@@ -136,8 +199,11 @@ class Task(BaseModel):
     done: bool
     createdAt: str
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+
+# список задач валидируем и сериализуем одним вызовом pydantic-core
+_TASKS_ADAPTER = TypeAdapter(List[Task])
 
 
 class TaskCreate(BaseModel):
@@ -160,47 +226,88 @@ class TaskPatch(BaseModel):
 # =========================
 
 def generate_id() -> str:
-    return str(uuid.uuid4())
+    # 32 hex-символа прямо из os.urandom, без промежуточного UUID
+    return secrets.token_hex(16)
+
 
+_WORD_RE = re.compile(r"\S+")
 
+
+@lru_cache(maxsize=1024)
 def make_title(text: str) -> str:
-    # Берём первые 5 слов описания
-    words = text.strip().split()
-    return " ".join(words[:5]) if words else "Без названия"
+    # Берём первые 5 слов описания, не разбивая на слова весь текст
+    words = [m.group() for m in islice(_WORD_RE.finditer(text), 5)]
+    return " ".join(words) if words else "Без названия"
+
+def iso_now() -> str:
+    # микросекунды не обрезаем: createdAt — единственный ключ сортировки задач
+    return datetime.now(timezone.utc).isoformat()
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    # слабые валидаторы (W/"...") для GET сравниваем так же, как сильные
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
 
 def to_public_user(user: UserORM) -> UserPublic:
-    return UserPublic(
-        id=user.id,
-        email=user.email,
-        name=user.name,
-        created_at=user.created_at,
-    )
+    return UserPublic.model_validate(user)
+
+_password_hasher = PasswordHasher()
+
 
 def hash_password(password: str) -> str:
     """
-    Простейший хэш. В продакшн так не делаем, но для личного планера ок.
+    Argon2id со своей солью на каждый хэш. Нужен только при регистрации и
+    логине — запросы с токеном (get_current_user) пароль не проверяют.
     """
-    import hashlib
+    return _password_hasher.hash(password)
+
 
+def legacy_hash_password(password: str) -> str:
+    """
+    Старый sha256 с общей солью. Оставлен только для проверки паролей
+    пользователей, зарегистрированных до перехода на argon2.
+    """
     salt = os.getenv("PASSWORD_SALT", "retro-planner-salt")
     return hashlib.sha256((salt + password).encode("utf-8")).hexdigest()
 
 
+def is_legacy_hash(password_hash: str) -> bool:
+    return not password_hash.startswith("$argon2")
+
+
 def verify_password(password: str, password_hash: str) -> bool:
-    return hash_password(password) == password_hash
+    if is_legacy_hash(password_hash):
+        return hmac.compare_digest(legacy_hash_password(password), password_hash)
+    try:
+        return _password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
 
 
-def create_session(db: Session, user_id: str) -> str:
-    token = uuid.uuid4().hex
+def password_needs_rehash(password_hash: str) -> bool:
+    return is_legacy_hash(password_hash) or _password_hasher.check_needs_rehash(
+        password_hash
+    )
+
+
+async def create_session(db: AsyncSession, user_id: str) -> str:
+    token = secrets.token_hex(16)
     session = SessionORM(token=token, user_id=user_id)
     db.add(session)
-    db.commit()
+    await db.commit()
     return token
 
 
-def get_current_user(
+# token -> user_id для горячих токенов. Кэш живёт в процессе, поэтому TTL
+# короткий: logout в другом воркере подхватится не позже чем через минуту.
+_session_cache: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+
+async def get_current_user(
     authorization: Optional[str] = Header(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ) -> UserORM:
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Не авторизовано")
@@ -209,22 +316,51 @@ def get_current_user(
     if not token:
         raise HTTPException(status_code=401, detail="Не авторизовано")
 
-    session = db.query(SessionORM).filter(SessionORM.token == token).first()
-    if not session:
-        raise HTTPException(status_code=401, detail="Токен недействителен")
-
-    user = db.query(UserORM).filter(UserORM.id == session.user_id).first()
+    user_id = _session_cache.get(token)
+    if user_id is not None:
+        user = await db.get(UserORM, user_id)
+        if user:
+            return user
+        _session_cache.pop(token, None)
+
+    # сессия и пользователь — одним запросом
+    user = (
+        await db.scalars(
+            select(UserORM)
+            .join(SessionORM, SessionORM.user_id == UserORM.id)
+            .where(SessionORM.token == token)
+        )
+    ).first()
     if not user:
-        raise HTTPException(status_code=401, detail="Пользователь не найден")
+        raise HTTPException(status_code=401, detail="Токен недействителен")
 
+    _session_cache[token] = user.id
     return user
 
 
 # Путь до старого файла с задачами (если он есть)
 TASKS_FILE = Path(__file__).parent / "tasks.json"
 
+# сколько строк отдаём в один executemany при миграции
+MIGRATION_CHUNK_SIZE = 10_000
+
+
+def load_tasks_from_file() -> list:
+    # orjson парсит прямо из байтов, без промежуточного декодирования в str
+    raw = TASKS_FILE.read_bytes()
+    # isspace() останавливается на первом значимом байте и не копирует буфер
+    if not raw or raw.isspace():
+        return []
+    data = orjson.loads(raw)
+
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        return data.get("tasks") or []
+    return []
+
 
-def migrate_from_file_if_needed():
+async def migrate_from_file_if_needed():
     # работаем только с локальной SQLite, в Postgres миграция не нужна
     if not str(DATABASE_URL).startswith("sqlite"):
         return
@@ -241,47 +377,44 @@ def migrate_from_file_if_needed():
 
     print("⏳ Мигрируем задачи из tasks.json в SQLite...")
 
-    with open(TASKS_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    tasks_data = load_tasks_from_file()
 
-    if isinstance(data, list):
-        tasks_data = data
-    elif isinstance(data, dict):
-        tasks_data = data.get("tasks") or []
-    else:
-        tasks_data = []
-
-    from datetime import datetime
-
-    with SessionLocal() as db:
+    async with SessionLocal() as db:
         # создаём демо-пользователя, чтобы старые задачи не потерялись
         demo_user = UserORM(
             id=generate_id(),
             email="demo@local",
             name="Demo user",
             password_hash=hash_password("demo"),
-            created_at=datetime.utcnow().isoformat(),
+            created_at=iso_now(),
         )
         db.add(demo_user)
-        db.commit()
-        db.refresh(demo_user)
-
-        for t in tasks_data:
-            task = TaskORM(
-                id=t.get("id") or generate_id(),
-                text=t.get("text", ""),
-                title=t.get("title") or make_title(t.get("text", "")),
-                category=t.get("category") or "work",
-                project=t.get("project") or "",
-                date=t.get("date"),
-                done=t.get("done", False),
-                createdAt=t.get("createdAt")
+        await db.commit()
+
+        rows = [
+            {
+                "id": t.get("id") or generate_id(),
+                "text": t.get("text", ""),
+                "title": t.get("title") or make_title(t.get("text", "")),
+                "category": t.get("category") or "work",
+                "project": t.get("project") or "",
+                "date": t.get("date"),
+                "done": t.get("done", False),
+                "createdAt": t.get("createdAt")
                 or t.get("created_at")
-                or datetime.utcnow().isoformat(),
-                user_id=demo_user.id,
+                or iso_now(),
+                "user_id": demo_user.id,
+            }
+            for t in tasks_data
+        ]
+
+        # вставляем пачками через Core insert, минуя unit of work ORM
+        for start in range(0, len(rows), MIGRATION_CHUNK_SIZE):
+            await db.execute(
+                TaskORM.__table__.insert(),
+                rows[start:start + MIGRATION_CHUNK_SIZE],
             )
-            db.add(task)
-        db.commit()
+        await db.commit()
 
     print("✅ Миграция завершена. Логин для старых задач: demo@local / demo")
 
@@ -303,26 +436,26 @@ app.add_middleware(
 
 
 @app.on_event("startup")
-def on_startup():
+async def on_startup():
     # создаём таблицы в БД, если их ещё нет
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
 
     # мигрируем из tasks.json в SQLite (если нужно)
-    migrate_from_file_if_needed()
+    await migrate_from_file_if_needed()
 
 
 # =========================
 #   ЭНДПОИНТЫ AUTH
 # =========================
 
-from datetime import datetime
-
-
 @app.post("/auth/register", response_model=AuthToken)
-def register_user(payload: UserCreate, db: Session = Depends(get_db)):
+async def register_user(payload: UserCreate, db: AsyncSession = Depends(get_db)):
     email = payload.email.lower().strip()
 
-    existing = db.query(UserORM).filter(UserORM.email == email).first()
+    existing = (
+        await db.scalars(select(UserORM).where(UserORM.email == email))
+    ).first()
     if existing:
         raise HTTPException(
             status_code=400, detail="Пользователь с таким email уже существует"
@@ -332,36 +465,44 @@ def register_user(payload: UserCreate, db: Session = Depends(get_db)):
         id=generate_id(),
         email=email,
         name=payload.name.strip() or email,
-        password_hash=hash_password(payload.password),
-        created_at=datetime.utcnow().isoformat(),
+        # argon2 считается долго — не держим на нём event loop
+        password_hash=await run_in_threadpool(hash_password, payload.password),
+        created_at=iso_now(),
     )
     db.add(user)
-    db.commit()
-    db.refresh(user)
+    await db.commit()
 
-    token = create_session(db, user.id)
+    token = await create_session(db, user.id)
     public_user = to_public_user(user)
     return AuthToken(token=token, user=public_user)
 
 
 @app.post("/auth/login", response_model=AuthToken)
-def login_user(payload: UserLogin, db: Session = Depends(get_db)):
+async def login_user(payload: UserLogin, db: AsyncSession = Depends(get_db)):
     email = payload.email.lower().strip()
-    user = db.query(UserORM).filter(UserORM.email == email).first()
+    user = (
+        await db.scalars(select(UserORM).where(UserORM.email == email))
+    ).first()
 
-    if not user or not verify_password(payload.password, user.password_hash):
+    if not user or not await run_in_threadpool(
+        verify_password, payload.password, user.password_hash
+    ):
         raise HTTPException(status_code=400, detail="Неверный email или пароль")
 
-    token = create_session(db, user.id)
+    # старые sha256-хэши и устаревшие параметры argon2 обновляем при входе
+    if password_needs_rehash(user.password_hash):
+        user.password_hash = await run_in_threadpool(hash_password, payload.password)
+
+    token = await create_session(db, user.id)
     public_user = to_public_user(user)
     return AuthToken(token=token, user=public_user)
 
 
 
 @app.post("/auth/logout", status_code=204)
-def logout_user(
+async def logout_user(
     authorization: Optional[str] = Header(None),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     if not authorization or not authorization.startswith("Bearer "):
         # тихо игнорируем
@@ -369,8 +510,9 @@ def logout_user(
     token = authorization.split(" ", 1)[1].strip()
     if not token:
         return
-    db.query(SessionORM).filter(SessionORM.token == token).delete()
-    db.commit()
+    _session_cache.pop(token, None)
+    await db.execute(delete(SessionORM).where(SessionORM.token == token))
+    await db.commit()
     return
 
 
@@ -379,24 +521,38 @@ def logout_user(
 # =======================
 
 @app.get("/tasks", response_model=List[Task])
-def get_tasks(
+async def get_tasks(
+    if_none_match: Optional[str] = Header(None),
     current_user: UserORM = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     tasks = (
-        db.query(TaskORM)
-        .filter(TaskORM.user_id == current_user.id)
-        .order_by(TaskORM.createdAt)
-        .all()
+        await db.scalars(
+            select(TaskORM)
+            .where(TaskORM.user_id == current_user.id)
+            .order_by(TaskORM.user_id, TaskORM.createdAt.desc())
+        )
+    ).all()
+
+    # отдельной версии у списка задач нет, поэтому ETag — хэш тела ответа
+    body = _TASKS_ADAPTER.dump_json(
+        _TASKS_ADAPTER.validate_python(tasks, from_attributes=True)
     )
-    return tasks
+    etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+    # no-cache: браузер хранит ответ, но каждый раз переспрашивает с If-None-Match
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @app.post("/tasks", response_model=Task)
-def create_task(
+async def create_task(
     payload: TaskCreate,
     current_user: UserORM = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
     text = payload.text.strip()
     if not text:
@@ -410,67 +566,78 @@ def create_task(
         project=payload.project or "",
         date=payload.date,
         done=False,
-        createdAt=datetime.utcnow().isoformat(),
+        createdAt=iso_now(),
         user_id=current_user.id,
     )
     db.add(task)
-    db.commit()
-    db.refresh(task)
+    await db.commit()
     return task
 
 
 @app.patch("/tasks/{task_id}", response_model=Task)
-def update_task(
+async def update_task(
     task_id: str,
     patch: TaskPatch,
     current_user: UserORM = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    task: TaskORM = (
-        db.query(TaskORM)
-        .filter(TaskORM.id == task_id, TaskORM.user_id == current_user.id)
-        .first()
-    )
-    if not task:
-        raise HTTPException(status_code=404, detail="Задача не найдена")
+    values = {}
 
     if patch.text is not None:
-        task.text = patch.text
-        task.title = make_title(patch.text)
+        values["text"] = patch.text
+        values["title"] = make_title(patch.text)
 
     if patch.category is not None:
-        task.category = patch.category
+        values["category"] = patch.category
 
     if patch.project is not None:
-        task.project = patch.project
+        values["project"] = patch.project
 
     if patch.date is not None:
-        task.date = patch.date
+        values["date"] = patch.date
 
     if patch.done is not None:
-        task.done = patch.done
+        values["done"] = patch.done
+
+    task_filter = (TaskORM.id == task_id, TaskORM.user_id == current_user.id)
 
-    db.commit()
-    db.refresh(task)
+    if values:
+        # один UPDATE ... RETURNING вместо SELECT + UPDATE
+        task: TaskORM = (
+            await db.execute(
+                update(TaskORM).where(*task_filter).values(**values).returning(TaskORM)
+            )
+        ).scalar_one_or_none()
+    else:
+        # пустой patch — менять нечего, просто отдаём задачу
+        task = (
+            await db.execute(select(TaskORM).where(*task_filter))
+        ).scalar_one_or_none()
+
+    if not task:
+        raise HTTPException(status_code=404, detail="Задача не найдена")
+
+    await db.commit()
     return task
 
 
 @app.delete("/tasks/{task_id}", status_code=204)
-def delete_task(
+async def delete_task(
     task_id: str,
     current_user: UserORM = Depends(get_current_user),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ):
-    task: TaskORM = (
-        db.query(TaskORM)
-        .filter(TaskORM.id == task_id, TaskORM.user_id == current_user.id)
-        .first()
-    )
-    if not task:
+    deleted_id = (
+        await db.execute(
+            delete(TaskORM)
+            .where(TaskORM.id == task_id, TaskORM.user_id == current_user.id)
+            .returning(TaskORM.id)
+        )
+    ).scalar_one_or_none()
+    if not deleted_id:
         raise HTTPException(status_code=404, detail="Задача не найдена")
 
-    db.delete(task)
-    db.commit()
+    await db.commit()
     return
 
 